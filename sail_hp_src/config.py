@@ -6,6 +6,21 @@ CONFIG = {
     # Fill value matching DOD (_FillValue = -9999)
     'fill_value': -9999,
 
+    # Fields read from the input files per season (classifier inputs)
+    'input_fields': {
+        'summer': [
+            'corrected_reflectivity', 'corrected_differential_reflectivity',
+            'corrected_specific_diff_phase', 'filtered_corrected_specific_diff_phase',
+            'RHOHV', 'sounding_temperature'
+        ],
+        'winter': [
+            'corrected_reflectivity', 'corrected_differential_reflectivity',
+            'corrected_specific_diff_phase', 'filtered_corrected_specific_diff_phase',
+            'RHOHV', 'sounding_temperature',
+            'DBZ', 'ZDR', 'PHIDP', 'signal_to_noise_ratio', 'height'
+        ]
+    },
+
     # Fields to retain in radar object before gridding
     'filter_fields': [
         'corrected_reflectivity', 'corrected_differential_reflectivity',
@@ -22,6 +37,41 @@ CONFIG = {
     'z_grid_limits': (500., 5_000.),
     'grid_resolution': 250,
 
+    # Run the CSU and Py-ART classifiers in two threads. Off by default: it holds both
+    # classifiers' working arrays at once and breaks the one-thread-per-worker layout
+    # run_hp_dask.py relies on.
+    'parallel_classifiers': False,
+
+    # Grid each cell from its nearest gate (Py-ART 'Nearest' weighting), with the gate
+    # index cached per scan strategy and reused across files. This is a different
+    # product from the default Barnes2-weighted gridding, and a cell whose nearest
+    # gate is masked stays masked instead of taking the next-nearest valid gate.
+    'reuse_grid_index': False,
+
+    # Largest per-ray azimuth/elevation offset (degrees) from the volume a cached
+    # index was built on for it to be reused; larger offsets rebuild the index
+    'grid_index_tolerance': 0.1,
+
+    # Deflate gridded output variables (False writes them contiguous, uncompressed)
+    'compress': True,
+
+    # Output file format: NETCDF4 (default), NETCDF4_CLASSIC or a NETCDF3_* format.
+    # The NETCDF3 formats have no chunking/compression, so 'compress' is ignored for them.
+    # NETCDF4 keeps the historical variable types (DOD 'float' -> f8, 'int' -> i8); the
+    # classic/NETCDF3 formats have no 64-bit integers and write 'float'/'int' as f4/i4.
+    'netcdf_format': 'NETCDF4',
+
+    # Per-variable least_significant_digit (DOD name -> digits), overriding any
+    # 'least_significant_digit:int' in the DOD. Lossy; e.g. {'corrected_reflectivity': 1}
+    'quantize': {},
+
+    # Scrub NaNs with numexpr's multi-threaded evaluator (ignored if numexpr is missing)
+    'parallel_scrub': False,
+
+    # Threads preparing output variables while the main thread writes them
+    # (1 keeps the writer single-threaded, e.g. under Dask's threads_per_worker=1)
+    'prep_workers': 1,
+
     # Classification methods mapped to fields (these fields exist in the DOD)
     'classification_fields': {
         'summer': {
@@ -1,66 +1,171 @@
 # hp_processing.py
 
 import pyart
+import copy
+import collections
+import functools
 import numpy as np
+import xarray as xr
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import subprocess
 import logging
 from csu_radartools import csu_fhc
+from csu_radartools.csu_fhc_melt import csu_fhc_cold_newml1
+
+logger = logging.getLogger(__name__)
 
 # Mappings for CSU Summer, Winter, and Py-ART classifications to HydroPhase (hp)
-csu_summer_to_hp = np.array([0, 1, 1, 2, 2, 4, 2, 3, 3, 3, 1])
-csu_winter_to_hp = np.array([0, 2, 2, 2, 2, 4, 3, 1])
-pyart_to_hp = np.array([0, 2, 2, 1, 3, 1, 2, 4, 4, 3])
+csu_summer_to_hp = np.array([0, 1, 1, 2, 2, 4, 2, 3, 3, 3, 1], dtype=np.int8)
+csu_winter_to_hp = np.array([0, 2, 2, 2, 2, 4, 3, 1], dtype=np.int8)
+pyart_to_hp = np.array([0, 2, 2, 1, 3, 1, 2, 4, 4, 3], dtype=np.int8)
+
+# Radar fields read by the CSU Summer, CSU Winter and Py-ART classifiers
+summer_inputs = ('corrected_reflectivity', 'corrected_differential_reflectivity',
+                 'corrected_specific_diff_phase', 'RHOHV', 'sounding_temperature')
+winter_inputs = ('DBZ', 'ZDR', 'PHIDP', 'RHOHV', 'signal_to_noise_ratio', 'sounding_temperature', 'height')
+pyart_inputs = ('corrected_reflectivity', 'corrected_differential_reflectivity',
+                'filtered_corrected_specific_diff_phase', 'RHOHV', 'sounding_temperature')
+
+# Radar frequency used for the Py-ART mass centers (X-band), shared by every file
+pyart_frequency = {'long_name': 'Radar frequency', 'units': 'Hz', 'data': np.array([9.2e9])}
 
 
-def read_radar(file, sweep=None):
-    radar = pyart.io.read(file)
+def read_radar(file, sweep=None, include_fields=None):
+    # Input is always CfRadial; skip format detection and unused fields
+    radar = pyart.io.read_cfradial(file, include_fields=include_fields)
     return radar.extract_sweeps([sweep]) if sweep is not None else radar
 
-def classify_summer(radar):
-    logging.info("Running CSU Summer classification")
-    dbz = radar.fields['corrected_reflectivity']['data']
-    zdr = radar.fields['corrected_differential_reflectivity']['data']
-    kdp = radar.fields['corrected_specific_diff_phase']['data']
-    rhv = radar.fields['RHOHV']['data']
-    rtemp = radar.fields['sounding_temperature']['data']
-    scores = csu_fhc.csu_fhc_summer(dz=dbz, zdr=zdr, rho=rhv, kdp=kdp, use_temp=True, band='X', T=rtemp)
-    return csu_summer_to_hp[scores]
-
-def classify_winter(radar):
-    logging.info("Running CSU Winter classification")
-    dz = np.ma.masked_array(radar.fields['DBZ']['data'])
-    zdr = np.ma.masked_array(radar.fields['ZDR']['data'])
-    kd = np.ma.masked_array(radar.fields['PHIDP']['data'])
-    rh = np.ma.masked_array(radar.fields['RHOHV']['data'])
-    sn = np.ma.masked_array(radar.fields['signal_to_noise_ratio']['data'])
-    rtemp = radar.fields['sounding_temperature']['data']
-    heights_km = radar.fields['height']['data'] / 1000
+def extract_inputs(radar, names):
+    """Collect field arrays by reference so classifiers do not hold the radar object."""
+    return {k: radar.fields[k]['data'] for k in names}
+
+def drop_unused_fields(radar, keep):
+    for k in [k for k in radar.fields if k not in keep]:
+        del radar.fields[k]
+
+def classify_summer(inputs):
+    logger.info("Running CSU Summer classification")
+    dbz = inputs['corrected_reflectivity']
+    zdr = inputs['corrected_differential_reflectivity']
+    kdp = inputs['corrected_specific_diff_phase']
+    rhv = inputs['RHOHV']
+    rtemp = inputs['sounding_temperature']
+    scores = csu_fhc.csu_fhc_summer(dz=dbz, zdr=zdr, rho=rhv, kdp=kdp, use_temp=True, band='X', T=rtemp,
+                                    return_scores=True)
+    # CSU categories are 1-based (argmax + 1); index 0 of the LUT is unclassified
+    idx = np.argmax(scores, axis=0).astype(np.int8, copy=False) + np.int8(1)
+    return np.take(csu_summer_to_hp, idx)
+
+def melting_level_ppi(fh, dz, heights, expected_ml, azimuths, nsect):
+    """
+    Melting level of csu_fhc_melt.get_ml_ppi (0 warm, 1 melting, 2 cold) from the median
+    wet-snow height in each azimuth sector. Rays are binned into sectors once with
+    searchsorted and each sector reads only its own rays, instead of masking the whole
+    volume once per sector. Returns the level array and the per-sector median heights.
+    """
+    edges = np.linspace(0, 360, nsect)
+    nsec = nsect - 1
+    # Sector i holds edges[i] <= azimuth < edges[i + 1]; -1 for rays outside [0, 360)
+    ray_sector = np.searchsorted(edges, np.ma.getdata(azimuths), side='right') - 1
+    ray_sector[ray_sector >= nsec] = -1
+
+    wet_snow = fh == 2
+    median_z = np.zeros(nsec)
+    for i in range(nsec):
+        rays = np.flatnonzero(ray_sector == i)
+        ws = wet_snow[rays]
+        ml_sector = heights[rays][ws]
+        # csu counts both index arrays of np.where, i.e. two entries per gate
+        per_ml = len(ml_sector) / (2 * ws.size) * 100. if ws.size else 0.
+        if per_ml > 0.05 and np.nanmean(dz[rays][ws]) > 15:
+            ml_median = np.median(ml_sector)
+            if np.abs(ml_median - expected_ml) > 2.0:
+                logger.warning("Melting layer is way off in sector %d (%.2f km vs expected %.2f km)",
+                               i, ml_median, expected_ml)
+            else:
+                median_z[i] = ml_median
+
+    ray_level = np.where(ray_sector >= 0, median_z[ray_sector], 0.)
+    level_z = np.repeat(ray_level[:, np.newaxis], fh.shape[1], axis=1)
+    meltlev = np.ones(fh.shape)
+    meltlev[np.where(heights >= level_z)] = 2
+    meltlev[np.where(heights <= level_z)] = 0
+    return meltlev, median_z
+
+def run_winter_ppi(dz, zdr, kdp, rho, sn, T, heights, azimuths, sn_thresh, expected_ml, nsect, min_rh=0.5):
+    """csu_fhc.run_winter for a PPI volume, with the sector statistics from melting_level_ppi."""
+    fdir = csu_fhc.CSV_DIR
+    # Wet snow vs other, QC'd by SNR and RHOHV (csu_fhc_melt.melting_layer)
+    scores_ml = csu_fhc_cold_newml1(dz=dz, zdr=zdr, rho=rho, kdp=kdp, use_temp=False, band='S',
+                                    method='linear', verbose=False, fdir=fdir)
+    fh = np.argmax(scores_ml, axis=0) + 1
+    fh[sn < sn_thresh] = 0
+    fh[np.where(np.isnan(rho.filled(fill_value=np.nan)))] = -1
+    fh[rho <= min_rh] = -1
+    meltlev, mean_melt = melting_level_ppi(fh, dz, heights, expected_ml, azimuths, nsect)
+    logger.debug("Radar melting level: %s km", np.mean(mean_melt))
+
+    # Warm (6 frozen, 7 rain) and cold layer HIDs, combined by melting level
+    scores_warm = csu_fhc.csu_fhc_winter(dz=dz, zdr=zdr, rho=None, kdp=kdp, use_temp=True, T=T, band='C',
+                                         warm=True, verbose=False, fdir=fdir)
+    fhwarm = np.argmax(scores_warm, axis=0) + 1
+    fhwarm[fhwarm == 1] = 6
+    fhwarm[fhwarm == 2] = 7
+    scores_cold = csu_fhc.csu_fhc_winter(dz=dz, zdr=zdr, rho=None, kdp=kdp, use_temp=True, T=T, band='C',
+                                         warm=False, verbose=False, fdir=fdir)
+    fhcold = np.argmax(scores_cold, axis=0) + 1
+
+    fh[fh == 2] = 5  # wet snow
+    winter_hca = np.zeros_like(fh) - 1
+    winter_hca[meltlev == 0] = fhwarm[meltlev == 0]
+    winter_hca[meltlev == 2] = fhcold[meltlev == 2]
+    winter_hca[fh == 5] = 5
+    winter_hca[fh == -1] = -1
+    winter_hca[fh == 0] = -1
+    return winter_hca
+
+def classify_winter(inputs, radar):
+    logger.info("Running CSU Winter classification")
+    # run_winter expects masked arrays; asanyarray returns Py-ART's MaskedArrays as-is
+    dz = np.ma.asanyarray(inputs['DBZ'])
+    zdr = np.ma.asanyarray(inputs['ZDR'])
+    kd = np.ma.asanyarray(inputs['PHIDP'])
+    rh = np.ma.asanyarray(inputs['RHOHV'])
+    sn = np.ma.asanyarray(inputs['signal_to_noise_ratio'])
+    rtemp = inputs['sounding_temperature']
+    # Scale instead of divide: MaskedArray division adds a divide-by-zero domain pass
+    heights_km = inputs['height'] * 1e-3
     azimuths = radar.azimuth['data']
-    hcawinter = csu_fhc.run_winter(dz=dz, zdr=zdr, kdp=kd, rho=rh, azimuths=azimuths, sn_thresh=-30,
-                                   expected_ML=2.0, sn=sn, T=rtemp, heights=heights_km, nsect=36,
-                                   scan_type=radar.scan_type, verbose=False, use_temp=True, band='S',
-                                   return_scores=False)
+    if radar.scan_type in ('rhi', 'grid'):
+        hcawinter = csu_fhc.run_winter(dz=dz, zdr=zdr, kdp=kd, rho=rh, azimuths=azimuths, sn_thresh=-30,
+                                       expected_ML=2.0, sn=sn, T=rtemp, heights=heights_km, nsect=36,
+                                       scan_type=radar.scan_type, verbose=False, use_temp=True, band='S',
+                                       return_scores=False)
+    else:
+        hcawinter = run_winter_ppi(dz, zdr, kd, rh, sn, rtemp, heights_km, azimuths,
+                                   sn_thresh=-30, expected_ml=2.0, nsect=36)
     return csu_winter_to_hp[hcawinter]
 
 def classify_pyart(radar):
-    logging.info("Running Py-ART classification")
-    radar.instrument_parameters['frequency'] = {'long_name': 'Radar frequency', 'units': 'Hz', 'data': [9.2e9]}
+    logger.info("Running Py-ART classification")
+    radar.instrument_parameters['frequency'] = pyart_frequency
     hydro = pyart.retrieve.hydroclass_semisupervised(radar,
                 refl_field="corrected_reflectivity",
                 zdr_field="corrected_differential_reflectivity",
                 kdp_field="filtered_corrected_specific_diff_phase",
                 rhv_field="RHOHV",
-                temp_field="sounding_temperature")
+                temp_field="sounding_temperature",
+                vectorize=True)
     return pyart_to_hp[hydro['data']]
 
 def add_classification_field(classified, radar, field_name, desc, config):
     fill = config["fill_value"]
-    masked = np.ma.asanyarray(classified)
     dz_field = 'corrected_reflectivity'
-    if hasattr(radar.fields[dz_field]['data'], 'mask'):
-        masked.mask = np.logical_or(masked.mask, radar.fields[dz_field]['data'].mask)
+    # Merge classification and reflectivity masks in one pass into a fresh mask
+    mask = np.logical_or(np.ma.getmask(classified), np.ma.getmask(radar.fields[dz_field]['data']))
+    masked = np.ma.masked_array(np.ma.getdata(classified).astype(np.int8, copy=False), mask=mask)
     field_dict = {
         'data': masked,
         'units': '', 'long_name': desc, 'standard_name': 'hydrometeor phase',
@@ -75,32 +180,117 @@ def filter_fields(radar, config):
 
 def compute_npoints(extent, res): return int((extent[1] - extent[0]) / res)
 
+@functools.lru_cache(maxsize=None)
+def grid_geometry(x_limits, y_limits, z_limits, resolution):
+    """Grid shape and limits in (z, y, x) order; computed once per run."""
+    grid_limits = (z_limits, y_limits, x_limits)
+    return tuple(compute_npoints(lim, resolution) for lim in grid_limits), grid_limits
+
+# Nearest-gate grid indexes for the most recently seen scan strategies (config['reuse_grid_index'])
+_GRID_INDEX_CACHE_SIZE = 4
+_grid_index_cache = collections.OrderedDict()
+
+def scan_strategy_key(radar, grid_shape, grid_limits):
+    """Nominal scan strategy and site, which stay fixed between volumes of the same scan task."""
+    return (radar.nsweeps, radar.nrays, radar.ngates,
+            tuple(np.round(radar.fixed_angle['data'], 1)),
+            round(float(radar.range['data'][0]), 1), round(float(radar.range['data'][-1]), 1),
+            round(float(radar.latitude['data'][0]), 4), round(float(radar.longitude['data'][0]), 4),
+            round(float(radar.altitude['data'][0])),
+            grid_shape, grid_limits)
+
+def max_angle_offset(a, b):
+    """Largest per-ray difference between two angle arrays in degrees, wrapping at 360."""
+    diff = np.abs(np.ma.getdata(a) - np.ma.getdata(b)) % 360.
+    return float(np.minimum(diff, 360. - diff).max(initial=0.))
+
+def build_grid_index(radar, grid_shape, grid_limits):
+    """
+    Grid gate numbers with Py-ART's 'Nearest' weighting, so each cell holds the number
+    of its nearest gate within the radius of influence. Returns the flat gate index,
+    the mask of cells no gate reaches, and an empty template grid.
+    """
+    gate_number = np.arange(radar.nrays * radar.ngates, dtype=np.float64).reshape(radar.nrays, radar.ngates)
+    index_radar = copy.copy(radar)
+    index_radar.fields = {'gate_number': {'data': np.ma.masked_array(gate_number)}}
+    template = pyart.map.grid_from_radars(index_radar, grid_shape=grid_shape, grid_limits=grid_limits,
+                                          weighting_function='Nearest')
+    index = template.fields.pop('gate_number')['data']
+    uncovered = np.ma.getmaskarray(index)
+    flat_index = np.rint(np.where(uncovered, 0, np.ma.getdata(index))).astype(np.intp).ravel()
+    return flat_index, uncovered, template
+
+def cached_grid_index(radar, grid_shape, grid_limits, tolerance):
+    """
+    Grid index for this radar's scan strategy, reused while every ray points within
+    `tolerance` degrees of the volume the index was built from; rebuilt otherwise.
+    """
+    key = scan_strategy_key(radar, grid_shape, grid_limits)
+    cached = _grid_index_cache.get(key)
+    if (cached is not None
+            and max_angle_offset(cached[0], radar.azimuth['data']) <= tolerance
+            and max_angle_offset(cached[1], radar.elevation['data']) <= tolerance):
+        _grid_index_cache.move_to_end(key)
+        return cached[2]
+    index = build_grid_index(radar, grid_shape, grid_limits)
+    _grid_index_cache[key] = (np.array(radar.azimuth['data']), np.array(radar.elevation['data']), index)
+    _grid_index_cache.move_to_end(key)
+    while len(_grid_index_cache) > _GRID_INDEX_CACHE_SIZE:
+        _grid_index_cache.popitem(last=False)
+    return index
+
+def regrid_from_index(radar, flat_index, uncovered, template):
+    grid = copy.copy(template)
+    grid.fields = {}
+    for name, field in radar.fields.items():
+        data = field['data']
+        values = np.ma.getdata(data).reshape(-1)[flat_index].reshape(uncovered.shape)
+        mask = np.ma.getmaskarray(data).reshape(-1)[flat_index].reshape(uncovered.shape) | uncovered
+        gridded = {k: v for k, v in field.items() if k != 'data'}
+        gridded['data'] = np.ma.masked_array(values, mask=mask)
+        grid.fields[name] = gridded
+    grid.time = dict(template.time, data=np.array([radar.time['data'][0]]), units=radar.time['units'])
+    return grid
+
 def grid_radar(radar, config):
-    xg = compute_npoints(config['x_grid_limits'], config['grid_resolution'])
-    yg = compute_npoints(config['y_grid_limits'], config['grid_resolution'])
-    zg = compute_npoints(config['z_grid_limits'], config['grid_resolution'])
-    grid = pyart.map.grid_from_radars(radar, grid_shape=(zg, yg, xg),
-                                      grid_limits=(config['z_grid_limits'],
-                                                   config['y_grid_limits'],
-                                                   config['x_grid_limits']),
-                                      method='nearest')
+    grid_shape, grid_limits = grid_geometry(config['x_grid_limits'], config['y_grid_limits'],
+                                            config['z_grid_limits'], config['grid_resolution'])
+    if config.get('reuse_grid_index', False):
+        # Nearest-gate product: not the same values as the default Barnes2 gridding below
+        index = cached_grid_index(radar, grid_shape, grid_limits, config.get('grid_index_tolerance', 0.1))
+        return regrid_from_index(radar, *index).to_xarray()
+    # Py-ART's default Barnes2 distance weighting (grid_from_radars has no 'method' option)
+    grid = pyart.map.grid_from_radars(radar, grid_shape=grid_shape, grid_limits=grid_limits)
     return grid.to_xarray()
 
 def subset_lowest_level(ds, config):
     hp_fields = [v for v in ds.variables if "hp" in v] + config["additional_fields"]
-    
-    # Create temporary height field masked by reflectivity, fillna with 10km (above grid)
-    ds["height_expanded"] = (ds.z * (ds.corrected_reflectivity/ds.corrected_reflectivity)).fillna(10_000)
-    
-    # Find the lowest valid level for each x,y pixel (2D index array)
-    min_index = ds.height_expanded.argmin(dim='z', skipna=True)
-    
+
+    # Height of each level where reflectivity is valid, 10km (above grid) elsewhere
+    refl = ds.corrected_reflectivity
+    z_axis = refl.get_axis_num('z')
+    z_shape = [1] * refl.ndim
+    z_shape[z_axis] = -1
+    z = ds.z.values.astype(np.float32).reshape(z_shape)
+    heights = np.where(np.isfinite(refl.values), z, np.float32(10_000.))
+
+    # Find the lowest valid level for each x,y pixel as one flat gather index shared by all fields
+    out_shape = heights.shape[:z_axis] + heights.shape[z_axis + 1:]
+    index = list(np.ogrid[tuple(slice(n) for n in out_shape)])
+    index.insert(z_axis, heights.argmin(axis=z_axis))
+    flat_index = np.ravel_multi_index(index, heights.shape)
+
     # Subset all hp fields and reflectivity at the lowest valid level
-    subset_ds = ds[hp_fields].isel(z=min_index)
-    
+    dims = tuple(d for d in refl.dims if d != 'z')
+    coords = {k: v for k, v in ds.coords.items() if 'z' not in v.dims}
+    subset_ds = xr.Dataset(coords=coords, attrs=ds.attrs)
+    for name in hp_fields:
+        field = ds[name].transpose(*refl.dims)
+        subset_ds[name] = (dims, np.take(field.values, flat_index), field.attrs)
+
     # Add the actual height values at those lowest levels as a new variable
-    subset_ds["lowest_height"] = ds.height_expanded.isel(z=min_index)
-    
+    subset_ds["lowest_height"] = (dims, np.take(heights, flat_index))
+
     return subset_ds
 
 def update_metadata(ds, config):
@@ -125,24 +315,37 @@ def make_squire_grid(radar, config):
     return ds
 
 def process_file(file, config, season):
-    radar = read_radar(file)
+    radar = read_radar(file, include_fields=config['input_fields'].get(season))
     
-    # Run CSU classification based on season
+    # Pick the CSU classification based on season
     if season == "summer":
-        field = config["classification_fields"]["summer"]["field_name"]
-        desc = config["classification_fields"]["summer"]["long_name"]
-        add_classification_field(classify_summer(radar), radar, field, desc, config)
+        csu = config["classification_fields"]["summer"]
+        csu_args = (classify_summer, extract_inputs(radar, summer_inputs))
     elif season == "winter":
-        field = config["classification_fields"]["winter"]["field_name"]
-        desc = config["classification_fields"]["winter"]["long_name"]
-        add_classification_field(classify_winter(radar), radar, field, desc, config)
+        csu = config["classification_fields"]["winter"]
+        csu_args = (classify_winter, extract_inputs(radar, winter_inputs), radar)
     else:
         raise ValueError(f"Invalid season: {season}. Must be 'summer' or 'winter'.")
-    
-    # Always run PyART classification
-    field = config["classification_fields"]["pyart"]["field_name"]
-    desc = config["classification_fields"]["pyart"]["long_name"]
-    add_classification_field(classify_pyart(radar), radar, field, desc, config)
+
+    # CSU inputs are held by reference; keep only what Py-ART and the grid need on the radar
+    drop_unused_fields(radar, set(config['filter_fields']).union(pyart_inputs))
+
+    # CSU and (always) PyART classification only read their inputs. Running them side by
+    # side holds both classifiers' working arrays at once, so it is opt-in.
+    if config.get('parallel_classifiers', False):
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            csu_future = pool.submit(*csu_args)
+            pyart_future = pool.submit(classify_pyart, radar)
+            del csu_args
+            csu_hp, pyart_hp = csu_future.result(), pyart_future.result()
+    else:
+        csu_hp = csu_args[0](*csu_args[1:])
+        del csu_args
+        pyart_hp = classify_pyart(radar)
+
+    add_classification_field(csu_hp, radar, csu["field_name"], csu["long_name"], config)
+    pyart_field = config["classification_fields"]["pyart"]
+    add_classification_field(pyart_hp, radar, pyart_field["field_name"], pyart_field["long_name"], config)
     
     radar = filter_fields(radar, config)
     return make_squire_grid(radar, config)
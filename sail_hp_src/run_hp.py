@@ -21,13 +21,10 @@ logger = logging.getLogger(__name__)
 
 
 def unprocessed_files(files, output_dir, config):
-    out = []
-    for file in files:
-        base = os.path.basename(file)
-        outfile = base.replace(config["input_file_pattern"], config["output_file_pattern"])
-        if not os.path.exists(os.path.join(output_dir, outfile)):
-            out.append(file)
-    return out
+    # One directory listing instead of a stat per file
+    existing = frozenset(os.listdir(output_dir))
+    ip, op = config["input_file_pattern"], config["output_file_pattern"]
+    return [f for f in files if os.path.basename(f).replace(ip, op) not in existing]
 
 def main():
     p = argparse.ArgumentParser()
@@ -69,15 +66,15 @@ def main():
     failures = 0
     
     for file_path in files:
-        logger.info(f"Processing: {file_path.name}")
+        logger.info("Processing: %s", file_path.name)
         try:
             ds = process_file(file_path, CONFIG, args.season)
             outname = Path(file_path.name.replace(CONFIG['input_file_pattern'], CONFIG['output_file_pattern']))
             write_ds_to_nc(ds, args.dod_template, out_dir / outname, CONFIG)
-            logger.info(f"Completed: {outname}")
+            logger.info("Completed: %s", outname)
             successes += 1
         except Exception as e:
-            logger.error(f"Failed to process {file_path.name}: {str(e)}")
+            logger.error("Failed to process %s: %s", file_path.name, e)
             failures += 1
     
     logger.info(f"Processing complete! Success: {successes}, Failed: {failures}")
@@ -40,27 +40,24 @@ logger = logging.getLogger(__name__)
 # Helpers
 # ---------------------------------------------------
 def get_unprocessed_files(input_files, output_dir, config):
-    out = []
-    for f in input_files:
-        base = os.path.basename(f)
-        outfile = base.replace(config["input_file_pattern"], config["output_file_pattern"])
-        if not (output_dir / outfile).exists():
-            out.append(f)
-    return out
+    # One directory listing instead of a stat per file
+    existing = frozenset(os.listdir(output_dir))
+    ip, op = config["input_file_pattern"], config["output_file_pattern"]
+    return [f for f in input_files if os.path.basename(f).replace(ip, op) not in existing]
 
 
 def process_single_file_wrapper(input_file, output_dir, dod_template, season, config):
     """Runs the heavy processing in one worker safely."""
     try:
-        logger.info(f"[START] {input_file}")
+        logger.info("[START] %s", input_file)
         ds = process_file(input_file, config, season)
         name = Path(input_file).name
         outname = name.replace(config["input_file_pattern"], config["output_file_pattern"])
         write_ds_to_nc(ds, dod_template, str(output_dir / outname), config)
-        logger.info(f"[DONE]  {outname}")
+        logger.info("[DONE]  %s", outname)
         return str(outname)
     except Exception as e:
-        logger.error(f"[FAIL] {input_file}: {e}")
+        logger.error("[FAIL] %s: %s", input_file, e)
         return None
 
 
@@ -83,7 +80,8 @@ def setup_local_cluster(n_workers=1, memory_limit="6GB"):
     Safer defaults:
       - 1 worker unless user requests more
       - strong memory caps to prevent kill/restart loops
-      - threads_per_worker=1 required for Py-ART/CSU
+      - threads_per_worker=1 required for Py-ART/CSU (keep config
+        'parallel_classifiers' and 'prep_workers' at their single-thread defaults)
     """
     cluster = LocalCluster(
         n_workers=n_workers,
@@ -109,13 +107,17 @@ def batch_process_dask(files, output_dir, dod_template, season, config, client,
     """
     logger.info(f"Processing {len(files)} files, batch_size={batch_size}")
 
+    # Ship config to every worker once instead of serializing it into each task
+    # (wrapped in a list: scatter() would split a dict into per-key futures)
+    [config_future] = client.scatter([config], broadcast=True)
+
     results = []
     done = 0
     good = 0
     bad = 0
 
     for idx, batch in enumerate(chunked(files, batch_size), 1):
-        logger.info(f"[BATCH {idx}] {len(batch)} tasks")
+        logger.info("[BATCH %d] %d tasks", idx, len(batch))
 
         futures = client.map(
             process_single_file_wrapper,
@@ -123,7 +125,7 @@ def batch_process_dask(files, output_dir, dod_template, season, config, client,
             output_dir=output_dir,
             dod_template=dod_template,
             season=season,
-            config=config,
+            config=config_future,
             retries=2,                     # auto retry on transient failure
             pure=False,                   # avoid unnecessary caching
         )
@@ -138,13 +140,13 @@ def batch_process_dask(files, output_dir, dod_template, season, config, client,
                 else:
                     good += 1
             except Exception as e:
-                logger.error(f"Future error: {e}")
+                logger.error("Future error: %s", e)
                 results.append(None)
                 bad += 1
                 done += 1
 
             if done % 10 == 0:
-                logger.info(f"[PROGRESS] {done}/{len(files)}  OK={good}  FAIL={bad}")
+                logger.info("[PROGRESS] %d/%d  OK=%d  FAIL=%d", done, len(files), good, bad)
 
     logger.info(f"[FINISHED] OK={good}, FAIL={bad}")
     return results
@@ -0,0 +1,83 @@
+"""Tests for the cached nearest-gate grid index (config['reuse_grid_index'])."""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+pyart = pytest.importorskip("pyart")
+pytest.importorskip("csu_radartools")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import hp_processing  # noqa: E402
+from config import CONFIG  # noqa: E402
+
+
+def make_ppi(azimuth_offset=0.0, elevation_jitter=0.0, seed=0):
+    """Three-sweep synthetic PPI with a random float32 reflectivity field."""
+    radar = pyart.testing.make_empty_ppi_radar(200, 360, 3)
+    radar.fixed_angle['data'] = np.array([0.5, 1.5, 2.5])
+    rng = np.random.default_rng(seed)
+    radar.azimuth['data'] = (radar.azimuth['data'] + azimuth_offset) % 360.
+    radar.elevation['data'] = (np.repeat(radar.fixed_angle['data'], 360)
+                               + rng.uniform(-elevation_jitter, elevation_jitter, radar.nrays))
+    radar.range['data'] = np.arange(200) * 100. + 50.
+    radar.init_gate_x_y_z()
+    radar.init_gate_longitude_latitude()
+    radar.init_gate_altitude()
+    refl = rng.normal(20., 10., (radar.nrays, radar.ngates)).astype(np.float32)
+    radar.add_field('corrected_reflectivity', {'data': np.ma.masked_array(refl)})
+    return radar
+
+
+@pytest.fixture
+def config():
+    hp_processing._grid_index_cache.clear()
+    yield dict(CONFIG, x_grid_limits=(-10_000., 10_000.), y_grid_limits=(-10_000., 10_000.),
+               z_grid_limits=(500., 2_000.), grid_resolution=500, reuse_grid_index=True)
+    hp_processing._grid_index_cache.clear()
+
+
+def nearest_reference(radar, config):
+    grid_shape, grid_limits = hp_processing.grid_geometry(
+        config['x_grid_limits'], config['y_grid_limits'], config['z_grid_limits'],
+        config['grid_resolution'])
+    grid = pyart.map.grid_from_radars(radar, grid_shape=grid_shape, grid_limits=grid_limits,
+                                      weighting_function='Nearest')
+    return np.ma.filled(grid.fields['corrected_reflectivity']['data'].astype(np.float64), np.nan)
+
+
+def test_reused_index_matches_pyart_nearest(config):
+    radar = make_ppi()
+    expected = nearest_reference(radar, config)
+    # First call builds the index, second reuses it; both must match Py-ART gate for gate
+    for _ in range(2):
+        ds = hp_processing.grid_radar(radar, config)
+        np.testing.assert_array_equal(ds.corrected_reflectivity.values[0], expected)
+    assert len(hp_processing._grid_index_cache) == 1
+
+
+def test_jittered_volume_hits_cache(config, monkeypatch):
+    hp_processing.grid_radar(make_ppi(seed=0), config)
+
+    def fail_build(*args, **kwargs):
+        raise AssertionError("grid index rebuilt for a volume within tolerance")
+
+    monkeypatch.setattr(hp_processing, "build_grid_index", fail_build)
+    hp_processing.grid_radar(make_ppi(azimuth_offset=0.05, elevation_jitter=0.05, seed=1), config)
+    assert len(hp_processing._grid_index_cache) == 1
+
+
+def test_rotated_volume_rebuilds_index(config):
+    hp_processing.grid_radar(make_ppi(), config)
+    rotated = make_ppi(azimuth_offset=0.5)
+    ds = hp_processing.grid_radar(rotated, config)
+    np.testing.assert_array_equal(ds.corrected_reflectivity.values[0], nearest_reference(rotated, config))
+
+
+def test_cache_is_bounded(config):
+    for n in range(hp_processing._GRID_INDEX_CACHE_SIZE + 2):
+        hp_processing.grid_radar(make_ppi(), dict(config, grid_resolution=500 + 50 * n))
+    assert len(hp_processing._grid_index_cache) == hp_processing._GRID_INDEX_CACHE_SIZE
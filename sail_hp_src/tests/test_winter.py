@@ -0,0 +1,46 @@
+"""Tests for the PPI port of csu_fhc.run_winter."""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pyart")
+csu_fhc = pytest.importorskip("csu_radartools.csu_fhc")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import hp_processing  # noqa: E402
+
+
+def make_inputs(seed, nrays, ngates=300, mean_dbz=25.):
+    """Random masked winter inputs on a 3 degree PPI."""
+    rng = np.random.default_rng(seed)
+    azimuths = (np.arange(nrays) * 360. / nrays + 0.7 * seed) % 360.
+    ranges = np.linspace(0.1, 30., ngates)
+    heights = np.sin(np.deg2rad(3.)) * ranges[None, :] * (1 + 0.3 * rng.random((nrays, 1)))
+
+    def masked(values):
+        return np.ma.masked_array(values, mask=rng.random(values.shape) < 0.1)
+
+    shape = (nrays, ngates)
+    return dict(dz=masked(rng.normal(mean_dbz, 10., shape)), zdr=masked(rng.normal(1., 1., shape)),
+                kdp=masked(rng.normal(50., 30., shape)),
+                rho=masked(np.clip(rng.normal(0.93, 0.05, shape), 0., 1.)),
+                sn=masked(rng.normal(10., 20., shape)),
+                T=np.ma.masked_array(5. - 6.5 * heights), heights=np.ma.masked_array(heights),
+                azimuths=azimuths)
+
+
+@pytest.mark.parametrize("seed, nrays, mean_dbz", [(0, 360, 25.), (1, 720, 25.), (2, 360, 12.)])
+def test_run_winter_ppi_matches_csu(seed, nrays, mean_dbz, monkeypatch):
+    # csu_radartools' get_ml_ppi still calls np.float, which NumPy >= 1.24 removed
+    monkeypatch.setattr(np, "float", float, raising=False)
+    inputs = make_inputs(seed, nrays, mean_dbz=mean_dbz)
+    expected = csu_fhc.run_winter(sn_thresh=-30, expected_ML=2.0, nsect=36, scan_type='ppi',
+                                  verbose=False, use_temp=True, band='S', return_scores=False, **inputs)
+    got = hp_processing.run_winter_ppi(inputs['dz'], inputs['zdr'], inputs['kdp'], inputs['rho'],
+                                       inputs['sn'], inputs['T'], inputs['heights'], inputs['azimuths'],
+                                       sn_thresh=-30, expected_ml=2.0, nsect=36)
+    np.testing.assert_array_equal(got, expected)
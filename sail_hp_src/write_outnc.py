@@ -1,10 +1,25 @@
 # write_outnc.py
 
+import copy
+import functools
+import os
 import re
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from pathlib import Path
 from netCDF4 import Dataset
 import numpy as np
 
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+# DOD variable declarations: "name(dim, ...):type" and scalar "name():type"
+_VAR_DIMS_RE = re.compile(r"^(\w+)\((.*?)\):(\w+)")
+_VAR_SCALAR_RE = re.compile(r"^(\w+)\(\):(\w+)")
+
 def _parse_attribute_value(key, value_str):
     """
     Parse attribute value with correct type based on type hint in key.
@@ -13,8 +28,8 @@ def _parse_attribute_value(key, value_str):
     value = value_str.strip().strip('"')
     
     # Check for type hints like _FillValue:float, flag_values:short
-    if ':' in key:
-        attr_name, type_hint = key.rsplit(':', 1)
+    attr_name, sep, type_hint = key.rpartition(':')
+    if sep:
         
         if type_hint == 'float':
             return attr_name, float(value)
@@ -35,80 +50,115 @@ def _parse_attribute_value(key, value_str):
     return key, value
 
 
+def _parse_toplevel_line(state, line):
+    """Dimension ("x = 160") or variable declaration ("name(dims):type")."""
+    if state["in_globals"]:
+        return
+    state["current_var"] = None
+    key, sep, val = line.partition("=")
+    if sep and "(" not in line and ":" not in line:
+        val = val.strip()
+        state["dimensions"][key.strip()] = None if val.upper() == "UNLIMITED" else int(val)
+        return
+    m = _VAR_DIMS_RE.match(line)
+    if m:
+        name, dims_str, dtype = m.groups()
+        dims_tuple = tuple(d.strip() for d in dims_str.split(",")) if dims_str else ()
+        state["variables"][name] = {"dtype": dtype, "dims": dims_tuple, "attrs": {}}
+        state["current_var"] = name
+        return
+    m2 = _VAR_SCALAR_RE.match(line)
+    if m2:
+        name, dtype = m2.groups()
+        state["variables"][name] = {"dtype": dtype, "dims": (), "attrs": {}}
+        state["current_var"] = name
+
+
+def _parse_attribute_line(state, line):
+    """Variable attribute, indented under its variable."""
+    current_var = state["current_var"]
+    if not current_var:
+        return
+    ak, sep, av = line.partition("=")
+    if sep:
+        # Parse with type conversion
+        clean_key, typed_value = _parse_attribute_value(ak.strip(), av.strip())
+        state["variables"][current_var]["attrs"][clean_key] = typed_value
+    else:
+        # Attribute with no value
+        state["variables"][current_var]["attrs"][line.partition(':')[0].rstrip()] = ""
+
+
+def _parse_global_line(state, line):
+    """Global attribute, indented under the '#' globals header."""
+    if not state["in_globals"]:
+        return
+    key, sep, val = line.partition("=")
+    if sep:
+        state["globals"][key.strip()] = val.strip().strip('"')
+    else:
+        state["globals"][line.rstrip()] = ""
+
+
+# DOD line kind is determined by its indentation
+_INDENT_HANDLERS = {0: _parse_toplevel_line, 4: _parse_attribute_line, 2: _parse_global_line}
+
+
 def _parse_dod(dod_path):
-    lines = Path(dod_path).read_text().splitlines()
-    dims, variables, globals_ = {}, {}, {}
-    current_var = None
-    in_globals = False
-
-    for raw in lines:
-        line = raw.rstrip().replace('\t', ' ')
-        if not line.strip():
+    text = Path(dod_path).read_text()
+    state = {"dimensions": {}, "variables": {}, "globals": {}, "current_var": None, "in_globals": False}
+
+    # splitlines() already drops line endings; trailing blanks only matter for
+    # bare keys, which the handlers strip themselves
+    for raw in text.splitlines():
+        line = raw.replace('\t', ' ') if '\t' in raw else raw
+        stripped = line.lstrip()
+        if not stripped:
             continue
-        if line.strip().startswith("#"):
-            in_globals = True
-            current_var = None
+        if stripped.startswith("#"):
+            state["in_globals"] = True
+            state["current_var"] = None
             continue
-        indent = len(line) - len(line.lstrip())
-        if not in_globals and indent == 0:
-            current_var = None
-            if "=" in line and "(" not in line and ":" not in line:
-                key, val = map(str.strip, line.split("=", 1))
-                dims[key] = None if val.upper() == "UNLIMITED" else int(val)
-                continue
-            m = re.match(r"^(\w+)\((.*?)\):(\w+)", line)
-            if m:
-                name, dims_str, dtype = m.groups()
-                dims_tuple = tuple(d.strip() for d in dims_str.split(",")) if dims_str else ()
-                variables[name] = {"dtype": dtype, "dims": dims_tuple, "attrs": {}}
-                current_var = name
-                continue
-            m2 = re.match(r"^(\w+)\(\):(\w+)", line)
-            if m2:
-                name, dtype = m2.groups()
-                variables[name] = {"dtype": dtype, "dims": (), "attrs": {}}
-                current_var = name
-                continue
-        elif indent == 4 and current_var:
-            if "=" in line:
-                ak, av = map(str.strip, line.split("=", 1))
-                # Parse with type conversion
-                clean_key, typed_value = _parse_attribute_value(ak, av)
-                variables[current_var]["attrs"][clean_key] = typed_value
-            else:
-                # Attribute with no value
-                clean_key = line.strip()
-                if ':' in clean_key:
-                    clean_key = clean_key.split(':')[0]
-                variables[current_var]["attrs"][clean_key] = ""
-        elif in_globals and indent == 2:
-            if "=" in line:
-                key, val = map(str.strip, line.split("=", 1))
-                globals_[key] = val.strip('"')
-            else:
-                globals_[line.strip()] = ""
-
-    return {"dimensions": dims, "variables": variables, "globals": globals_}
+        handler = _INDENT_HANDLERS.get(len(line) - len(stripped))
+        if handler:
+            handler(state, stripped)
+
+    return {"dimensions": state["dimensions"], "variables": state["variables"], "globals": state["globals"]}
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_dod_cached(dod_path, mtime_ns):
+    return _parse_dod(dod_path)
+
+
+def _dod_key(dod_path):
+    """Cache key for a DOD template: its path and modification time."""
+    dod_path = str(dod_path)
+    return dod_path, os.stat(dod_path).st_mtime_ns
+
+
+def _load_dod(dod_key):
+    """Parsed DOD template, re-parsed only when the file changes. Returns a private copy (callers mutate it)."""
+    return copy.deepcopy(_parse_dod_cached(*dod_key))
+
+
+# Host name is fixed for the life of the process; look it up once
+_HOSTNAME = socket.gethostname() or "unknown"
+_HISTORY_TIME_FMT = "%Y-%m-%d %H:%M:%S UTC"
 
 
 def _update_dod_globals(dod, config):
     """Fill missing global attributes from config"""
     import sys
-    import subprocess
-    from datetime import datetime
-    
+
     missing = []
 
     # Auto-generate command_line
     config["command_line"] = " ".join(sys.argv) if hasattr(sys, "argv") and len(sys.argv) > 0 else "notebook"
 
     # Auto-generate history with timestamp and system info
-    current_time = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
-    try:
-        system_info = subprocess.check_output(['uname', '-n'], encoding='utf-8').strip()
-    except:
-        system_info = "unknown"
-    config["history"] = f"created on {current_time} on {system_info}"
+    current_time = datetime.now(timezone.utc).strftime(_HISTORY_TIME_FMT)
+    config["history"] = f"created on {current_time} on {_HOSTNAME}"
 
     # For every global attr DOD defines:
     for key, val in dod["globals"].items():
@@ -127,49 +177,110 @@ def _update_dod_globals(dod, config):
 
 
 
-def _create_nc_structure(path, dod):
-    nc = Dataset(path, "w", format="NETCDF4")
+# Upper bound on uncompressed chunk size for deflated variables
+_CHUNK_MAX_BYTES = 4 * 2**20
+
+
+def _chunk_shape(shape, itemsize):
+    """
+    Largest trailing block of `shape` that fits in _CHUNK_MAX_BYTES.
+    Leading dims are shrunk first; the last (x) dim is never split.
+    """
+    chunks = list(shape)
+    for i in range(len(chunks) - 1):
+        nbytes = itemsize * int(np.prod(chunks))
+        if nbytes <= _CHUNK_MAX_BYTES:
+            break
+        chunks[i] = max(1, _CHUNK_MAX_BYTES // (nbytes // chunks[i]))
+    return tuple(chunks)
 
-    for dim, size in dod["dimensions"].items():
-        nc.createDimension(dim, size)
 
-    for gk, gv in dod["globals"].items():
-        setattr(nc, gk, gv)
+# Output formats accepted for config['netcdf_format']; the netCDF-3 ones have
+# no chunking or compression
+_NETCDF_FORMATS = ("NETCDF4", "NETCDF4_CLASSIC",
+                   "NETCDF3_CLASSIC", "NETCDF3_64BIT_OFFSET", "NETCDF3_64BIT_DATA")
 
+
+# DOD attributes consumed by createVariable rather than written as attributes
+_DEFINE_ATTRS = frozenset({"_FillValue", "least_significant_digit"})
+
+
+@functools.lru_cache(maxsize=8)
+def _define_plan(dod_key, compress, quantize, classic=False):
+    """
+    createVariable arguments for every DOD variable, worked out once per
+    template (dod_key from _dod_key) and option set. quantize is a tuple of
+    (variable, digits) pairs so it can be part of the cache key. classic
+    creates variables with the netCDF meaning of the DOD type names
+    ('int' is 32-bit), as the classic data model has no 64-bit integers.
+    """
+    dod = _parse_dod_cached(*dod_key)
+    quantize = dict(quantize)
+    plan = []
     for varname, vinfo in dod["variables"].items():
         dtype = vinfo["dtype"]
+        if classic:
+            dtype = _DOD_VALUE_DTYPES.get(dtype, dtype)
         dims = vinfo["dims"]
-        attrs = dict(vinfo["attrs"])
+        attrs = vinfo["attrs"]
 
-        fill = attrs.pop("_FillValue", None)
-        var = nc.createVariable(varname, dtype, dims, fill_value=fill) if fill else nc.createVariable(varname, dtype, dims)
+        fill = attrs.get("_FillValue")
+        kwargs = {"fill_value": fill} if fill else {}
 
-        for ak, av in attrs.items():
-            setattr(var, ak, av)
+        # Lossy: values are rounded to this many decimal digits before writing.
+        # netCDF4 records the attribute itself.
+        lsd = quantize.get(varname, attrs.get("least_significant_digit"))
+        if lsd is not None:
+            kwargs["least_significant_digit"] = lsd
 
-    return nc
+        # Deflate gridded fields; unlimited (time) dims get one step per chunk.
+        # Scalar/1-D metadata stays contiguous, compression overhead would exceed the payload.
+        if compress and len(dims) >= 2:
+            shape = tuple(dod["dimensions"][d] or 1 for d in dims)
+            kwargs.update(zlib=True, shuffle=True, complevel=1,
+                          chunksizes=_chunk_shape(shape, np.dtype(dtype).itemsize))
 
+        plan.append((varname, dtype, dims, kwargs))
+    return tuple(plan)
 
 
+def _create_nc_structure(path, dod, plan, fmt="NETCDF4"):
+    nc = Dataset(path, "w", format=fmt)
+
+    # Define everything first, then attach attributes: dimensions, variables,
+    # variable attributes, globals.
+    for dim, size in dod["dimensions"].items():
+        nc.createDimension(dim, size)
 
+    for varname, dtype, dims, kwargs in plan:
+        nc.createVariable(varname, dtype, dims, **kwargs)
 
-from datetime import datetime, timezone
+    # Attribute values are per file (time units etc.), so they come from dod
+    for varname, var in nc.variables.items():
+        attrs = dod["variables"][varname]["attrs"]
+        var.setncatts({k: v for k, v in attrs.items() if k not in _DEFINE_ATTRS})
 
+    nc.setncatts(dod["globals"])
 
-def _get_standardized_times(ds):
-    t = ds.time.values[0]
-    t64 = np.datetime64(t)
-    dt = t64.astype("datetime64[s]").astype(datetime)
+    # Values arrive already filled and cast to the DOD dtype; skip netCDF4's
+    # per-write masking and scaling. Must follow createVariable to take effect.
+    nc.set_auto_maskandscale(False)
 
-    base_time_val = int((t64 - np.datetime64("1970-01-01T00:00:00Z")) /
-                        np.timedelta64(1, "s"))
+    return nc
 
-    midnight = datetime(dt.year, dt.month, dt.day, tzinfo=timezone.utc)
-    midnight64 = np.datetime64(midnight)
-    time_since_midnight_val = (t64 - midnight64) / np.timedelta64(1, "s")
+
+def _get_standardized_times(ds):
+    # Stay in datetime64 space: integer seconds for base_time, day-truncation
+    # for midnight, and numpy's ISO formatting for the strings.
+    t64 = np.datetime64(ds.time.values[0])
+    t_s = t64.astype("datetime64[s]")
+    day = t64.astype("datetime64[D]")
+
+    base_time_val = t_s.astype(np.int64)
+    time_since_midnight_val = (t64 - day) / np.timedelta64(1, "s")
 
     # Format scan time string
-    scan_time_str = dt.strftime("%Y-%m-%d %H:%M:%S 0:00")
+    scan_time_str = str(t_s).replace("T", " ") + " 0:00"
 
     return {
         "base_time": {
@@ -183,14 +294,12 @@ def _get_standardized_times(ds):
         },
         "time": {
             "value": np.array([time_since_midnight_val], dtype="float64"),
-            "units": f"seconds since {dt.strftime('%Y-%m-%d 00:00:00 0:00')}",
+            "units": f"seconds since {day} 00:00:00 0:00",
             "string": scan_time_str
         }
     }
 
-def _update_dod_time_attributes(dod, ds):
-    times = _get_standardized_times(ds)
-
+def _update_dod_time_attributes(dod, times):
     for tname, meta in times.items():
         if tname not in dod["variables"]:
             continue
@@ -207,25 +316,85 @@ def _update_dod_time_attributes(dod, ds):
 
 
 
-def _write_dataset_to_file(ds, nc, dod, config):
+# Value dtype for each DOD type name, as dtype objects for cheap comparison
+_DOD_VALUE_DTYPES = {
+    'float': np.dtype(np.float32),
+    'double': np.dtype(np.float64),
+    'short': np.dtype(np.int16),
+    'int': np.dtype(np.int32),
+    'byte': np.dtype(np.int8)
+}
+
+
+def _scratch_buffer(scratch, shape, dtype):
+    """Uninitialised array from the scratch dict, reused per (shape, dtype)."""
+    if scratch is None:
+        return np.empty(shape, dtype)
+    key = (shape, np.dtype(dtype))
+    buf = scratch.get(key)
+    if buf is None:
+        buf = scratch[key] = np.empty(shape, dtype)
+    return buf
+
+
+def _prepare_values(data, dod_fill, target_dtype, parallel=False, scratch=None):
+    """
+    Fill masked and NaN values with the DOD fill value and cast to the DOD dtype,
+    fused into a single output buffer. Returns the input values (no copy) when
+    nothing needs changing. With parallel=True and numexpr installed, float
+    scrubbing runs multi-threaded instead. Passing a scratch dict reuses the
+    mask and output buffers across calls; the result is then only valid until
+    the next call with the same dict.
+    """
+    values = np.ma.getdata(data)
+    # Byte order alone is not a reason to copy; netCDF4 swaps on write
+    if target_dtype is None or values.dtype.newbyteorder("=") == target_dtype:
+        target_dtype = values.dtype
+
+    bad = np.ma.getmask(data)
+    # Only float values can hold NaN; integer/bool fields skip isnan entirely
+    scrub_nan = dod_fill is not None and np.issubdtype(values.dtype, np.floating)
+    if parallel and ne is not None and scrub_nan:
+        local = {"v": values, "f": np.asarray(dod_fill, values.dtype)}
+        expr = "where(v != v, f, v)"
+        if bad is not np.ma.nomask:
+            local["m"] = bad
+            expr = "where((v != v) | m, f, v)"
+        return ne.evaluate(expr, local_dict=local).astype(target_dtype, copy=False)
+
+    fill = data.fill_value if dod_fill is None and bad is not np.ma.nomask else dod_fill
+    if scrub_nan:
+        nan = np.isnan(values, out=_scratch_buffer(scratch, values.shape, bool))
+        bad = nan if bad is np.ma.nomask else np.logical_or(nan, bad, out=nan)
+    if not np.any(bad):
+        return values.astype(target_dtype, copy=False)
+
+    out = _scratch_buffer(scratch, values.shape, target_dtype)
+    with np.errstate(invalid="ignore"):  # NaNs cast to int are overwritten below
+        np.copyto(out, values, casting="unsafe")
+    np.copyto(out, fill, where=bad, casting="unsafe")
+    return out
+
+
+def _write_dataset_to_file(ds, nc, dod, config, times):
     """Write only data values (no attributes). All attrs come from DOD."""
-    
-    # Standardized numeric time variables
-    times = _get_standardized_times(ds)
 
     # Variables that MUST NOT be written from ds
     time_vars = {"time", "time_offset", "base_time"}
 
-    # Type mapping from DOD dtype to numpy dtype
-    dtype_map = {
-        'float': np.float32,
-        'double': np.float64,
-        'short': np.int16,
-        'int': np.int32,
-        'byte': np.int8
-    }
+    parallel_scrub = config.get("parallel_scrub", False)
+    prep_workers = config.get("prep_workers", 1)
+
+    # Write in DOD (file definition) order so the data is laid down sequentially
+    dod_order = {name: i for i, name in enumerate(dod["variables"])}
+    ordered = sorted(
+        ((xr_name, dod_name) for xr_name, dod_name in config["variable_mapping"].items()
+         if dod_name in dod_order),
+        key=lambda kv: dod_order[kv[1]]
+    )
 
-    for xr_name, dod_name in config["variable_mapping"].items():
+    jobs = []
+    for xr_name, dod_name in ordered:
 
         # Skip variables not in ds or not in nc
         if xr_name not in ds or dod_name not in nc.variables:
@@ -235,36 +404,43 @@ def _write_dataset_to_file(ds, nc, dod, config):
         if dod_name in time_vars:
             continue
 
+        # Ensure time is never written from ds: cftime (or any Python
+        # object) values only ever come as object dtype, so check before .values
+        if ds[xr_name].dtype == object:
+            raise TypeError(
+                f"Attempted to write cftime/object values for variable {xr_name}. "
+                "Time variables are not allowed to come from ds."
+            )
+
         data = ds[xr_name].values
         var = nc.variables[dod_name]
 
         # Get fill value from variable
         dod_fill = getattr(var, "_FillValue", None)
 
-        # Handle masked fields
-        if hasattr(data, "mask"):
-            data = np.ma.filled(data, fill_value=dod_fill)
-
-        # Replace NaN with DOD fill value
-        if dod_fill is not None and np.any(np.isnan(data)):
-            data = np.where(np.isnan(data), dod_fill, data)
-
-        # Ensure time is never written from ds
-        if len(data) > 0 and "cftime" in str(type(data.flat[0])):
-            raise TypeError(
-                f"Attempted to write cftime object for variable {xr_name}. "
-                "Time variables are not allowed to come from ds."
-            )
-
-        # Convert to correct dtype based on DOD specification
+        # Correct dtype based on DOD specification
+        target_dtype = None
         if dod_name in dod["variables"]:
-            dod_dtype = dod["variables"][dod_name]["dtype"]
-            target_dtype = dtype_map.get(dod_dtype)
-            if target_dtype and data.dtype != target_dtype:
-                data = data.astype(target_dtype)
-
-        # Now safe to write
-        nc.variables[dod_name][:] = data
+            target_dtype = _DOD_VALUE_DTYPES.get(dod["variables"][dod_name]["dtype"])
+
+        jobs.append((dod_name, data, dod_fill, target_dtype))
+
+    # Masked fill, NaN scrub and dtype cast in one pass per variable, then write
+    if prep_workers > 1 and len(jobs) > 1:
+        # Only the NumPy prep runs in the pool (it releases the GIL); every
+        # netCDF4/HDF5 call stays on this thread. Each task gets its own buffers.
+        with ThreadPoolExecutor(max_workers=prep_workers) as pool:
+            futures = [(dod_name, pool.submit(_prepare_values, data, dod_fill,
+                                              target_dtype, parallel_scrub))
+                       for dod_name, data, dod_fill, target_dtype in jobs]
+            for dod_name, future in futures:
+                nc.variables[dod_name][:] = future.result()
+    else:
+        # Output/mask buffers shared by same-shape fields; each is written before reuse
+        scratch = {}
+        for dod_name, data, dod_fill, target_dtype in jobs:
+            nc.variables[dod_name][:] = _prepare_values(data, dod_fill, target_dtype,
+                                                        parallel_scrub, scratch)
 
     # Write standardized numeric time variables only
     for tname, tinfo in times.items():
@@ -297,18 +473,30 @@ def _write_dataset_to_file(ds, nc, dod, config):
 
 def write_ds_to_nc(ds, dod_template_path, output_path, config):
     """Write xarray dataset to NetCDF using DOD template"""
-    dod = _parse_dod(dod_template_path)
+    dod_key = _dod_key(dod_template_path)
+    dod = _load_dod(dod_key)
 
     dod = _update_dod_globals(dod, config)
-    dod = _update_dod_time_attributes(dod, ds)
 
-    nc = _create_nc_structure(output_path, dod)
-    
-    # Dynamically generate 'fields' global attribute from actual variables
-    variable_list = list(nc.variables.keys())
-    nc.fields = ', '.join(variable_list)
-    
-    _write_dataset_to_file(ds, nc, dod, config)
+    # Standardized numeric time variables, shared by the attrs and the data
+    times = _get_standardized_times(ds)
+    dod = _update_dod_time_attributes(dod, times)
+
+    fmt = config.get("netcdf_format", "NETCDF4")
+    if fmt not in _NETCDF_FORMATS:
+        raise ValueError(f"Unsupported netcdf_format {fmt!r}; expected one of {_NETCDF_FORMATS}")
+    compress = config.get("compress", True) and not fmt.startswith("NETCDF3")
+
+    # Dynamically generate 'fields' global attribute from the variables; set
+    # with the other globals so the file is fully defined before any data
+    dod["globals"]["fields"] = ', '.join(dod["variables"])
+
+    plan = _define_plan(dod_key, compress,
+                        tuple(sorted((config.get("quantize") or {}).items())),
+                        classic=fmt != "NETCDF4")
+    nc = _create_nc_structure(output_path, dod, plan, fmt)
+
+    _write_dataset_to_file(ds, nc, dod, config, times)
 
 
 